@@ -16,19 +16,37 @@ Usage:
 """
 
 from __future__ import annotations
-import pathlib, re, sys, textwrap
-from dataclasses import dataclass
-from typing import Dict, Optional, Tuple
-
-# ─────────────────────────────── CLI ─────────────────────────────────────────
-if len(sys.argv) != 3:
-  sys.exit("Usage: inject_protovalidate.py <smithy-root-dir> <proto-root-dir>")
-
-SMITHY_ROOT = pathlib.Path(sys.argv[1]).resolve()
-PROTO_ROOT  = pathlib.Path(sys.argv[2]).resolve()
+import contextlib, functools, os, pathlib, re, shutil, sys, tempfile, textwrap
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, fields
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# ───────────────── File discovery ────────────────────────────────────────────
+# os.scandir serves is_dir/is_file from the cached DirEntry (no extra stat)
+def _walk(root: pathlib.Path, ext: str) -> Iterator[str]:
+  stack = [os.fspath(root)]
+  while stack:
+    try:
+      it = os.scandir(stack.pop())
+    except OSError:  # missing root or unreadable subdirectory: skipped, as rglob did
+      continue
+    with it:
+      for entry in it:
+        if entry.is_dir(follow_symlinks=False):
+          stack.append(entry.path)
+        elif entry.name.endswith(ext) and entry.is_file():
+          yield entry.path
+
+# Sources stay str rather than bytes: ASCII text is already stored one byte per
+# char, and constraint values, dict keys and the emitted options are all str.
+# Decoding is pinned to UTF-8 (Smithy's encoding) so it hits the codec fast path
+# instead of depending on the locale.
+def _read(path: str) -> str:
+  with open(path, encoding="utf-8") as fh:
+    return fh.read()
 
 # ───────────────── Trait model ───────────────────────────────────────────────
-@dataclass
+@dataclass(slots=True)
 class Constraints:
   str_min: Optional[str] = None
   str_max: Optional[str] = None
@@ -38,16 +56,15 @@ class Constraints:
   rep_max: Optional[str] = None
   unique : bool          = False
 
-  def merge(self, other: "Constraints") -> "Constraints":
-    return Constraints(
-      str_min = other.str_min or self.str_min,
-      str_max = other.str_max or self.str_max,
-      num_min = other.num_min or self.num_min,
-      num_max = other.num_max or self.num_max,
-      rep_min = other.rep_min or self.rep_min,
-      rep_max = other.rep_max or self.rep_max,
-      unique  = self.unique or other.unique,
-    )
+  # fill unset fields from *other* in place; values already on self win
+  def merge_into(self, other: "Constraints") -> None:
+    for f in _FIELDS:
+      v = getattr(other, f)
+      if v and not getattr(self, f):
+        setattr(self, f, v)
+
+  def as_tuple(self) -> ConsKey:
+    return tuple(getattr(self, f) for f in _FIELDS)
 
   def __bool__(self) -> bool:
     return any((
@@ -57,84 +74,146 @@ class Constraints:
       self.unique,
     ))
 
+_FIELDS = tuple(f.name for f in fields(Constraints))
+
+# hashable field values of one Constraints, in declaration order
+ConsKey = Tuple[object, ...]
+
 # ──────────────── Regex helpers ──────────────────────────────────────────────
-RE_STRUCT        = re.compile(r"\bstructure\s+(\w+)\s*{", re.I)
-RE_TRAIT         = re.compile(r"@\w+[^@{}]*")
-RE_STRING_ALIAS  = re.compile(r"\bstring\s+(\w+)\b", re.I)
-RE_LIST_ALIAS    = re.compile(r"\blist\s+(\w+)\s*{", re.I)
+# Smithy and proto identifiers are ASCII → re.A skips Unicode class lookups
+RE_STRUCT        = re.compile(r"\bstructure\s+(\w+)\s*{", re.I | re.A)
+RE_TRAIT         = re.compile(r"@(length|range|uniqueItems)\b(?:\s*\(([^)]*)\))?", re.A)
+RE_STRING_ALIAS  = re.compile(r"\bstring\s+(\w+)\b", re.I | re.A)
+RE_LIST_ALIAS    = re.compile(r"\blist\s+(\w+)\s*{", re.I | re.A)
 
+RE_BRACE         = re.compile(r"[{}]")
+
+# possessive quantifiers (Python 3.11+) → no backtracking into trait lines
 MEMBER_RX = re.compile(
-  r'(?:\s*(?P<traits>(?:@\w+[^\n]*\n\s*)*))'   # 0-n trait lines
-  r'\s*(?P<name>\w+)\s*:\s*(?P<target>\w+)',   # member line
-  re.M,
+  r'\s*+(?P<traits>(?:@\w+[^\n]*\n\s*)*+)'     # 0-n trait lines
+  r'(?P<name>\w+)\s*:\s*(?P<target>\w+)',       # member line
+  re.M | re.A,
 )
 
-MSG_RX   = re.compile(r"^\s*message\s+(\w+)\s*{", re.I)
-FIELD_RX = re.compile(
-  r"^\s*(repeated\s+|optional\s+)?(\w+)\s+(\w+)\s*=\s*(\d+)([^;]*);", re.I
+# one sweep over a whole .proto: either a message header or a field line
+# ([^\S\n] keeps field matches on a single line, as with per-line matching)
+PROTO_RX = re.compile(
+  r"^[^\S\n]*message\s+(?P<msg>\w+)\s*{"
+  r"|^[^\S\n]*(?P<label>repeated[^\S\n]+|optional[^\S\n]+)?"
+  r"(?P<ftype>\w+)[^\S\n]+(?P<fname>\w+)[^\S\n]*=[^\S\n]*\d+(?P<tail>[^;\n]*);",
+  re.I | re.M | re.A,
 )
 
+_PICK = {
+  key: re.compile(fr"\b{key}\s*:\s*(-?[0-9]+(?:\.[0-9]+)?)", re.A)
+  for key in ("min", "max")
+}
+
 # ──────────────── Trait extraction helpers ──────────────────────────────────
+TRAIT_TOKENS = ("@length", "@range", "@uniqueItems")
+
+# plain substring checks are far cheaper than running the regex passes
+def _has_traits(txt: str) -> bool:
+  return any(tok in txt for tok in TRAIT_TOKENS)
+
 def _pick(blob: str, key: str) -> Optional[str]:
-  m = re.search(fr"\b{key}\s*:\s*(-?[0-9]+(?:\.[0-9]+)?)", blob)
+  m = _PICK[key].search(blob)
   return m.group(1) if m else None
 
 def gather_constraints(trait_block: str) -> Constraints:
   c = Constraints()
-  for trait in RE_TRAIT.findall(trait_block):
-    if trait.startswith("@length"):
-      inner = trait[8:].strip("()")
-      c.str_min = _pick(inner, "min") or c.str_min
-      c.str_max = _pick(inner, "max") or c.str_max
-      c.rep_min = _pick(inner, "min") or c.rep_min
-      c.rep_max = _pick(inner, "max") or c.rep_max
-    elif trait.startswith("@range"):
-      inner = trait[7:].strip("()")
-      c.num_min = _pick(inner, "min") or c.num_min
-      c.num_max = _pick(inner, "max") or c.num_max
-    elif trait.startswith("@uniqueItems"):
+  for m in RE_TRAIT.finditer(trait_block):
+    name, args = m.groups()
+    if name == "uniqueItems":
       c.unique = True
+      continue
+    if not args:
+      continue
+
+    lo, hi = _pick(args, "min"), _pick(args, "max")
+    if name == "length":
+      c.str_min = c.rep_min = lo or c.str_min
+      c.str_max = c.rep_max = hi or c.str_max
+    else:  # range
+      c.num_min = lo or c.num_min
+      c.num_max = hi or c.num_max
   return c
 
+# text between the '{' just before *start* and its matching '}'
+def _block_body(txt: str, start: int) -> str:
+  depth = 1
+  for b in RE_BRACE.finditer(txt, start):
+    depth += 1 if b.group() == "{" else -1
+    if not depth:
+      return txt[start:b.start()]
+  return txt[start:]
+
 # ──────────────── Pass 1 – alias-level constraints ──────────────────────────
-alias_constraints: Dict[str, Constraints] = {}
+# Shape/member names used as dict keys are sys.intern'ed here and at lookup
+# time in patch_proto, so key comparisons short-circuit on identity.
+def collect_alias_constraints(sources: List[str]) -> Dict[str, Constraints]:
+  alias_constraints: Dict[str, Constraints] = {}
+
+  for txt in sources:
+    if not _has_traits(txt):  # no trait → every alias here is unconstrained
+      continue
 
-for sm in SMITHY_ROOT.rglob("*.smithy"):
-  txt = sm.read_text()
+    # string aliases (traits live *before* the alias line)
+    for m in RE_STRING_ALIAS.finditer(txt):
+      alias_constraints[sys.intern(m.group(1))] = gather_constraints(txt[:m.start()])
 
-  # string aliases (traits live *before* the alias line)
-  for m in RE_STRING_ALIAS.finditer(txt):
-    alias_constraints[m.group(1)] = gather_constraints(txt[:m.start()])
+    # list aliases (traits can be before *and/or* **inside** the block)
+    for m in RE_LIST_ALIAS.finditer(txt):
+      alias = sys.intern(m.group(1))
+      block = txt[m.start():m.end()] + _block_body(txt, m.end())
+      alias_constraints[alias] = gather_constraints(block)
 
-  # list aliases (traits can be before *and/or* **inside** the block)
-  for m in RE_LIST_ALIAS.finditer(txt):
-    alias = m.group(1)
-    brace_open = txt.find("{", m.end() - 1)
-    brace_close = txt.find("}", brace_open)
-    block = txt[m.start(): brace_close + 1] if brace_close != -1 else txt[m.start():]
-    alias_constraints[alias] = gather_constraints(block)
+  return alias_constraints
 
 # ──────────────── Pass 2 – member-level constraints ─────────────────────────
-member_constraints: Dict[Tuple[str, str], Constraints] = {}
+def collect_member_constraints(
+  sources: List[str],
+  alias_constraints: Dict[str, Constraints],
+) -> Dict[Tuple[str, str], Constraints]:
+  member_constraints: Dict[Tuple[str, str], Constraints] = {}
+  # a trait-less file still matters if it names a constrained alias
+  constrained = sorted(a for a, c in alias_constraints.items() if c)
+  alias_rx = (
+    re.compile(r"\b(?:%s)\b" % "|".join(map(re.escape, constrained)), re.A)
+    if constrained else None
+  )
+
+  for txt in sources:
+    if not _has_traits(txt) and not (alias_rx and alias_rx.search(txt)):
+      continue
+    for st in RE_STRUCT.finditer(txt):
+      struct = sys.intern(st.group(1))
+      body   = _block_body(txt, st.end())
+      for mem in MEMBER_RX.finditer(body):
+        traits  = mem.group("traits") or ""
+        name    = sys.intern(mem.group("name"))
+        target  = sys.intern(mem.group("target"))
 
-for sm in SMITHY_ROOT.rglob("*.smithy"):
-  txt = sm.read_text()
-  for st in RE_STRUCT.finditer(txt):
-    struct = st.group(1)
-    body   = txt[st.end(): txt.find("}", st.end())]
-    for mem in MEMBER_RX.finditer(body):
-      traits  = mem.group("traits") or ""
-      name    = mem.group("name")
-      target  = mem.group("target")
+        cons = gather_constraints(traits)
+        if target in alias_constraints:
+          cons.merge_into(alias_constraints[target])
 
-      cons = gather_constraints(traits)
-      if target in alias_constraints:
-        cons = alias_constraints[target].merge(cons)
+        if cons:
+          member_constraints[(struct, name)] = cons
 
-      if cons:
-        member_constraints[(struct, name)] = cons
+  return member_constraints
 
 # ──────────────── Option string builder ─────────────────────────────────────
+# protovalidate has one rule group per numeric scalar, named after the type;
+# anything not listed falls back to int32 as before
+_NUM_CAT = {
+  t: t for t in (
+    "double", "float",
+    "int32", "int64", "uint32", "uint64", "sint32", "sint64",
+    "fixed32", "fixed64", "sfixed32", "sfixed64",
+  )
+}
+
 def build_option(ftype: str, repeated: bool, c: Constraints) -> str:
   attrs: list[str] = []
 
@@ -148,10 +227,7 @@ def build_option(ftype: str, repeated: bool, c: Constraints) -> str:
     if c.str_max: attrs.append(f"string.max_len = {c.str_max}")
 
   else:  # numeric groups
-    cat = ("double" if ftype == "double"
-           else "float"  if ftype == "float"
-           else "int64"  if ftype.endswith("64")
-           else "int32")
+    cat = _NUM_CAT.get(ftype, "int32")
     if c.num_min: attrs.append(f"{cat}.gte = {c.num_min}")
     if c.num_max: attrs.append(f"{cat}.lte = {c.num_max}")
 
@@ -164,61 +240,181 @@ def build_option(ftype: str, repeated: bool, c: Constraints) -> str:
   lined = ",\n  ".join(f"(buf.validate.field).{a}" for a in attrs)
   return f" [\n  {lined}\n]"
 
-# ───────────────── Proto patching ───────────────────────────────────────────
-patched_fields = total_proto = 0
-IMPORT_RX = re.compile(r'\s*import\s+"buf/validate/validate\.proto";')
+# fields sharing an alias render the same option; build each shape only once
+@functools.lru_cache(maxsize=None)
+def build_option_cached(ftype: str, repeated: bool, cons_key: ConsKey) -> str:
+  return build_option(ftype, repeated, Constraints(*cons_key))
 
-for proto in PROTO_ROOT.rglob("*.proto"):
-  total_proto += 1
-  lines = proto.read_text().splitlines()
-  dirty = False
+# ───────────────── Proto patching ───────────────────────────────────────────
+RE_MSG_KW   = re.compile(r"message", re.I | re.A)  # same keyword test as PROTO_RX
+IMPORT_PATH = "buf/validate/validate.proto"
+IMPORT_LINE = f'import "{IMPORT_PATH}";'
+IMPORT_RX = re.compile(r'^[^\S\n]*import\s+"buf/validate/validate\.proto";$', re.M | re.A)
+
+# untouched slices of *text* interleaved with the replacements, in file order;
+# streamed to the writer so the patched file never exists as one second string
+def _edited_parts(text: str, edits: List[Tuple[int, int, str]]) -> Iterator[str]:
+  pos = 0
+  for start, end, repl in sorted(edits):
+    yield text[pos:start]
+    yield repl
+    pos = end
+  yield text[pos:]
+
+# write to a temp file beside the real target (through any symlink) and rename
+# it over the target: readers never see a half-written proto, and an
+# interrupted run leaves the original intact
+def _write_atomic(path: str, parts: Iterable[str]) -> None:
+  target = os.path.realpath(path)
+  fd, tmp = tempfile.mkstemp(
+    dir=os.path.dirname(target), prefix=os.path.basename(target) + ".", suffix=".tmp"
+  )
+  try:
+    with open(fd, "w", encoding="utf-8") as fh:
+      fh.writelines(parts)
+    shutil.copymode(target, tmp)
+    os.replace(tmp, target)
+  except BaseException:
+    with contextlib.suppress(FileNotFoundError):
+      os.remove(tmp)
+    raise
+
+def _line_offset(text: str, n: int) -> int:
+  pos = 0
+  for _ in range(n):
+    nl = text.find("\n", pos)
+    if nl == -1:
+      return -1
+    pos = nl + 1
+  return pos
+
+# Patch one .proto file in place; returns the number of fields patched.
+# *member_keys* maps (message, field) to the option cache key of its constraints.
+def patch_proto(
+  proto: str,
+  member_keys: Dict[Tuple[str, str], ConsKey],
+) -> int:
+  text  = _read(proto)
+  edits: List[Tuple[int, int, str]] = []
   ctx   = None
+  # no message → no field to patch; go straight to import handling
+  fields_and_msgs = PROTO_RX.finditer(text) if RE_MSG_KW.search(text) else ()
 
-  for i, line in enumerate(lines):
-    if (m := MSG_RX.match(line)):
-      ctx = m.group(1)
+  for m in fields_and_msgs:
+    if m.group("msg"):
+      ctx = sys.intern(m.group("msg"))
       continue
 
-    m = FIELD_RX.match(line)
-    if not (ctx and m):
+    if not ctx or "buf.validate.field" in m.group("tail"):
       continue
 
-    rep_kw, ftype, fname, _tag, tail = m.groups()
-    repeated = (rep_kw or "").strip() == "repeated"
-    if "buf.validate.field" in tail:
+    cons_key = member_keys.get((ctx, sys.intern(m.group("fname"))))
+    if cons_key is None:
       continue
 
-    cons = member_constraints.get((ctx, fname))
-    if not cons:
-      continue
-
-    option = build_option(ftype, repeated, cons)
+    repeated = (m.group("label") or "").strip() == "repeated"
+    option = build_option_cached(m.group("ftype"), repeated, cons_key)
     if not option:
       continue
 
-    lines[i] = line.rstrip(";") + option + ";"
-    dirty = True
-    patched_fields += 1
+    semi = m.end() - 1  # option goes right before the terminating ';'
+    edits.append((semi, semi, option))
+
+  dirty = bool(edits)
+  patched_fields = len(edits)
 
   # normalise & deduplicate import lines
-  imports = [idx for idx, l in enumerate(lines) if IMPORT_RX.fullmatch(l)]
+  # (most files carry no validate import yet; a substring test rules them out)
+  imports = list(IMPORT_RX.finditer(text)) if IMPORT_PATH in text else []
   if imports:
     first = imports[0]
-    lines[first] = 'import "buf/validate/validate.proto";'
-    for idx in reversed(imports[1:]):
-      del lines[idx]
+    if first.group() != IMPORT_LINE:
+      edits.append((first.start(), first.end(), IMPORT_LINE))
+    for dup in imports[1:]:  # drop the whole line, newline included
+      edits.append((dup.start(), min(dup.end() + 1, len(text)), ""))
   elif dirty:  # need to add one
+    head = text.split("\n", 2)
     insert_at = (
-      2 if len(lines) > 1 and lines[0].startswith("syntax")
-           and lines[1].startswith("package")
+      2 if len(head) > 1 and head[0].startswith("syntax")
+           and head[1].startswith("package")
       else 1
     )
-    lines.insert(insert_at, 'import "buf/validate/validate.proto";')
+    at = _line_offset(text, insert_at)
+    if at == -1:  # file is shorter than the insertion line
+      edits.append((len(text), len(text), "\n" + IMPORT_LINE))
+    else:
+      edits.append((at, at, IMPORT_LINE + "\n"))
+
+  if edits:  # leave already-normalised files untouched on disk
+    _write_atomic(proto, _edited_parts(text, edits))
+
+  return patched_fields
+
+# Worker-side copy of the member table, shipped once per process by the pool
+# initializer instead of once per task.
+_WORKER_KEYS: Dict[Tuple[str, str], ConsKey] = {}
+
+def _init_worker(member_keys: Dict[Tuple[str, str], ConsKey]) -> None:
+  global _WORKER_KEYS
+  # unpickled keys are fresh objects; re-intern so lookups hit identity checks
+  _WORKER_KEYS = {
+    (sys.intern(struct), sys.intern(name)): cons_key
+    for (struct, name), cons_key in member_keys.items()
+  }
+
+def _patch_in_worker(proto: str) -> int:
+  return patch_proto(proto, _WORKER_KEYS)
+
+# Starting the pool costs ~15 ms; a generated proto patches in ~1-2 ms, so
+# below this many files the serial loop finishes first.
+_PARALLEL_MIN_FILES = 32
+
+# CPUs this process may run on (honours affinity masks, e.g. in containers)
+def _available_cpus() -> int:
+  if hasattr(os, "sched_getaffinity"):
+    return len(os.sched_getaffinity(0))
+  return os.cpu_count() or 1
+
+def patch_protos(
+  proto_files: List[str],
+  member_constraints: Dict[Tuple[str, str], Constraints],
+) -> int:
+  # freeze each member's cache key once, not once per matching field
+  member_keys = {k: cons.as_tuple() for k, cons in member_constraints.items()}
+
+  # files are independent once the member table is known → fan out
+  workers = min(len(proto_files), _available_cpus())
+  if len(proto_files) < _PARALLEL_MIN_FILES or workers < 2:
+    return sum(patch_proto(p, member_keys) for p in proto_files)
+
+  # several chunks per worker so uneven file sizes still balance out
+  chunksize = max(1, min(16, len(proto_files) // (workers * 4)))
+  with ProcessPoolExecutor(
+    max_workers=workers,
+    initializer=_init_worker, initargs=(member_keys,),
+  ) as ex:
+    return sum(ex.map(_patch_in_worker, proto_files, chunksize=chunksize))
+
+# ─────────────────────────────── CLI ─────────────────────────────────────────
+def main(argv: List[str]) -> None:
+  if len(argv) != 3:
+    sys.exit("Usage: inject_protovalidate.py <smithy-root-dir> <proto-root-dir>")
+
+  smithy_root = pathlib.Path(argv[1]).resolve()
+  proto_root  = pathlib.Path(argv[2]).resolve()
+
+  # read once, scanned by both passes
+  smithy_sources = [_read(sm) for sm in _walk(smithy_root, ".smithy")]
+  alias_constraints  = collect_alias_constraints(smithy_sources)
+  member_constraints = collect_member_constraints(smithy_sources, alias_constraints)
+
+  proto_files = list(_walk(proto_root, ".proto"))
+  patched_fields = patch_protos(proto_files, member_constraints)
 
-  if dirty or imports:
-    proto.write_text("\n".join(lines))
+  print(textwrap.dedent(f"""
+    Patched {patched_fields} field(s)
+    across  {len(proto_files)} .proto file(s).
+  """).strip())
 
-print(textwrap.dedent(f"""
-  Patched {patched_fields} field(s)
-  across  {total_proto} .proto file(s).
-""").strip())
+if __name__ == "__main__":
+  main(sys.argv)
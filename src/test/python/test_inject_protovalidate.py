@@ -5,7 +5,7 @@ Run:  pytest -q
 """
 
 from __future__ import annotations
-import subprocess, sys, tempfile
+import os, subprocess, sys, tempfile
 from pathlib import Path
 
 SCRIPT = (Path(__file__).resolve().parents[2] / "main/python/inject_protovalidate.py").as_posix()
@@ -23,11 +23,12 @@ def _make_env(model: str, proto: str) -> tuple[Path, Path]:
   _write(proot / "model.proto", proto)
   return sroot, proot
 
-def _run(sroot: Path, proot: Path) -> None:
+def _run(sroot: Path, proot: Path, timeout: float | None = None) -> None:
   subprocess.run(
     [sys.executable, SCRIPT, sroot.as_posix(), proot.as_posix()],
     check=True,
     text=True,
+    timeout=timeout,
   )
 
 # ---------------------------------------------------------------------------
@@ -127,3 +128,361 @@ def test_import_inserted_once():
   lines = (proot / "model.proto").read_text().splitlines()
   imports = [l for l in lines if l.strip() == 'import "buf/validate/validate.proto";']
   assert len(imports) == 1
+
+
+def test_many_proto_files_patched():
+  smithy = """
+    namespace demo
+    structure Msg {
+      @length(max: 5)
+      txt: String
+    }
+  """
+  proto = """
+    syntax = "proto3";
+    message Msg {
+      string txt = 1;
+    }
+  """
+  sroot, proot = _make_env(smithy, proto)
+  for i in range(40):
+    _write(proot / f"nested/copy{i}.proto", proto)
+  _run(sroot, proot)
+
+  for p in [proot / "model.proto", *(proot / "nested").glob("*.proto")]:
+    assert "(buf.validate.field).string.max_len = 5" in p.read_text()
+
+
+def test_duplicate_imports_collapsed_and_trailing_newline_kept():
+  smithy = """
+    namespace demo
+    structure Msg {
+      @length(max: 5)
+      txt: String
+    }
+  """
+  proto = (
+    'syntax = "proto3";\n'
+    'import "buf/validate/validate.proto";\n'
+    '  import "buf/validate/validate.proto";\n'
+    "message Msg {\n"
+    "  string txt = 1;\n"
+    "}\n"
+  )
+  sroot, proot = _make_env(smithy, proto)
+  _run(sroot, proot)
+  out = (proot / "model.proto").read_text()
+
+  assert out.count("import \"buf/validate/validate.proto\";") == 1
+  assert out.endswith("}\n")
+
+
+def test_unchanged_file_not_rewritten():
+  smithy = """
+    namespace demo
+    structure Other {
+      @length(max: 5)
+      txt: String
+    }
+  """
+  proto = (
+    'syntax = "proto3";\n'
+    'import "buf/validate/validate.proto";\n'
+    "message Msg {\n"
+    "  string txt = 1;\n"
+    "}\n"
+  )
+  sroot, proot = _make_env(smithy, proto)
+  target = proot / "model.proto"
+  os.utime(target, ns=(0, 0))
+  _run(sroot, proot)
+
+  assert target.stat().st_mtime_ns == 0
+  assert target.read_text() == proto
+
+
+def test_alias_from_other_file():
+  smithy = """
+    namespace demo
+    structure Bag {
+      ids: IdList
+    }
+  """
+  proto = """
+    syntax = "proto3";
+    message Bag {
+      repeated string ids = 1;
+    }
+  """
+  sroot, proot = _make_env(smithy, proto)
+  _write(sroot / "aliases.smithy", """
+    namespace demo
+    list IdList {
+      @length(max: 3)
+      member: String
+    }
+  """)
+  _run(sroot, proot)
+  out = (proot / "model.proto").read_text()
+
+  assert "(buf.validate.field).repeated.max_items = 3" in out
+
+
+def test_struct_body_with_nested_braces():
+  smithy = """
+    namespace demo
+    structure Msg {
+      @default({})
+      tags: TagMap
+      @length(max: 5)
+      txt: String
+    }
+  """
+  proto = """
+    syntax = "proto3";
+    message Msg {
+      map<string, string> tags = 1;
+      string txt = 2;
+    }
+  """
+  sroot, proot = _make_env(smithy, proto)
+  _run(sroot, proot)
+  out = (proot / "model.proto").read_text()
+
+  assert "(buf.validate.field).string.max_len = 5" in out
+
+
+def test_long_whitespace_in_struct_body_is_linear():
+  # the previous MEMBER_RX backtracked cubically on runs like this
+  smithy = (
+    "namespace demo\n"
+    "structure Msg {\n"
+    "  @length(max: 5)\n"
+    "  txt: String\n"
+    + " " * 5000 + "\n"
+    "  @required\n"
+    + " " * 5000 + "}\n"
+  )
+  proto = """
+    syntax = "proto3";
+    message Msg {
+      string txt = 1;
+    }
+  """
+  sroot, proot = _make_env(smithy, proto)
+  _run(sroot, proot, timeout=30)
+  out = (proot / "model.proto").read_text()
+
+  assert "(buf.validate.field).string.max_len = 5" in out
+
+
+def test_numeric_range_uses_field_scalar_type():
+  smithy = """
+    namespace demo
+    structure Counter {
+      @range(min: 0, max: 9000)
+      total: Long
+      @range(max: 10)
+      delta: Long
+      @range(max: 7)
+      small: Integer
+    }
+  """
+  proto = """
+    syntax = "proto3";
+    message Counter {
+      uint64 total = 1;
+      sfixed64 delta = 2;
+      uint32 small = 3;
+    }
+  """
+  sroot, proot = _make_env(smithy, proto)
+  _run(sroot, proot)
+  out = (proot / "model.proto").read_text()
+
+  assert "(buf.validate.field).uint64.gte = 0" in out
+  assert "(buf.validate.field).uint64.lte = 9000" in out
+  assert "(buf.validate.field).sfixed64.lte = 10" in out
+  assert "(buf.validate.field).uint32.lte = 7" in out
+  assert ").int64." not in out
+  assert ").int32." not in out
+
+
+def test_patched_file_keeps_mode_and_leaves_no_temp_file():
+  smithy = """
+    namespace demo
+    structure Msg {
+      @length(max: 5)
+      txt: String
+    }
+  """
+  proto = """
+    syntax = "proto3";
+    message Msg {
+      string txt = 1;
+    }
+  """
+  sroot, proot = _make_env(smithy, proto)
+  target = proot / "model.proto"
+  target.chmod(0o640)
+  _run(sroot, proot)
+
+  assert "(buf.validate.field).string.max_len = 5" in target.read_text()
+  assert target.stat().st_mode & 0o777 == 0o640
+  assert sorted(p.name for p in proot.iterdir()) == ["model.proto"]
+
+
+def test_traits_with_supported_prefix_ignored():
+  smithy = """
+    namespace demo
+    list IdList {
+      @uniqueItemsFoo
+      @lengthX(max: 3)
+      member: String
+    }
+
+    structure Bag {
+      @rangeish(max: 4)
+      ids: IdList
+      @length(max: 2)
+      tags: IdList
+    }
+  """
+  proto = """
+    syntax = "proto3";
+    message Bag {
+      repeated string ids = 1;
+      repeated string tags = 2;
+    }
+  """
+  sroot, proot = _make_env(smithy, proto)
+  _run(sroot, proot)
+  out = (proot / "model.proto").read_text()
+
+  assert "repeated string ids = 1;" in out
+  assert "(buf.validate.field).repeated.max_items = 2" in out
+  assert "unique" not in out
+  assert "max_items = 3" not in out
+
+
+def test_message_header_with_tab_patched():
+  smithy = """
+    namespace demo
+    structure Msg {
+      @length(max: 5)
+      txt: String
+    }
+  """
+  proto = 'syntax = "proto3";\nmessage\tMsg {\n  string txt = 1;\n}\n'
+  sroot, proot = _make_env(smithy, proto)
+  _run(sroot, proot)
+  out = (proot / "model.proto").read_text()
+
+  assert "(buf.validate.field).string.max_len = 5" in out
+
+
+def test_imports_deduplicated_without_messages():
+  smithy = """
+    namespace demo
+    structure Msg {
+      @length(max: 5)
+      txt: String
+    }
+  """
+  proto = (
+    'syntax = "proto3";\n'
+    'import "buf/validate/validate.proto";\n'
+    'import "buf/validate/validate.proto";\n'
+    "enum Kind {\n"
+    "  KIND_UNSPECIFIED = 0;\n"
+    "}\n"
+  )
+  sroot, proot = _make_env(smithy, proto)
+  _run(sroot, proot)
+  out = (proot / "model.proto").read_text()
+
+  assert out.count('import "buf/validate/validate.proto";') == 1
+  assert "enum Kind {" in out
+
+
+def test_missing_root_matches_nothing():
+  sroot, proot = _make_env("namespace demo\n", 'syntax = "proto3";\n')
+  missing = proot.parent / "does-not-exist"
+  res = subprocess.run(
+    [sys.executable, SCRIPT, sroot.as_posix(), missing.as_posix()],
+    capture_output=True,
+    text=True,
+  )
+
+  assert res.returncode == 0
+  assert "across  0 .proto file(s)" in res.stdout
+  assert "Traceback" not in res.stderr
+
+
+def test_symlinked_proto_patches_target_and_keeps_link():
+  smithy = """
+    namespace demo
+    structure Msg {
+      @length(max: 5)
+      txt: String
+    }
+  """
+  proto = """
+    syntax = "proto3";
+    message Msg {
+      string txt = 1;
+    }
+  """
+  sroot, proot = _make_env(smithy, proto)
+  real = proot.parent / "real" / "target.proto"
+  real.parent.mkdir()
+  (proot / "model.proto").rename(real)
+  (proot / "link.proto").symlink_to(real)
+  stray = real.parent / "target.proto.tmp"
+  stray.write_text("keep me")
+  _run(sroot, proot)
+
+  assert (proot / "link.proto").is_symlink()
+  assert "(buf.validate.field).string.max_len = 5" in real.read_text()
+  assert stray.read_text() == "keep me"
+  assert sorted(p.name for p in real.parent.iterdir()) == ["target.proto", "target.proto.tmp"]
+
+
+def test_process_pool_path(monkeypatch):
+  # drive patch_protos directly so the pool runs even on single-CPU hosts
+  monkeypatch.syspath_prepend(Path(SCRIPT).parent.as_posix())
+  import inject_protovalidate as ip
+  monkeypatch.setattr(ip, "_available_cpus", lambda: 4)
+
+  proto = 'syntax = "proto3";\nmessage Msg {\n  string txt = 1;\n}\n'
+  _, proot = _make_env("namespace demo\n", proto)
+  files = [proot / "model.proto"]
+  for i in range(ip._PARALLEL_MIN_FILES):
+    _write(proot / f"copy{i}.proto", proto)
+    files.append(proot / f"copy{i}.proto")
+
+  members = {("Msg", "txt"): ip.Constraints(str_max="5")}
+  assert ip.patch_protos([f.as_posix() for f in files], members) == len(files)
+  for f in files:
+    assert "(buf.validate.field).string.max_len = 5" in f.read_text()
+
+
+def test_member_pass_skips_only_irrelevant_trait_free_files(monkeypatch):
+  monkeypatch.syspath_prepend(Path(SCRIPT).parent.as_posix())
+  import inject_protovalidate as ip
+
+  scanned: list[str] = []
+  real_rx = ip.RE_STRUCT
+  class _Spy:
+    def finditer(self, txt, *args):
+      scanned.append(txt)
+      return real_rx.finditer(txt, *args)
+  monkeypatch.setattr(ip, "RE_STRUCT", _Spy())
+
+  aliases = {"IdList": ip.Constraints(rep_max="3"), "Plain": ip.Constraints()}
+  uses_alias = "structure Bag {\n  ids: IdList\n}\n"
+  unrelated  = "structure Other {\n  ids: Plain\n}\n"
+  members = ip.collect_member_constraints([uses_alias, unrelated], aliases)
+
+  assert scanned == [uses_alias]
+  assert members[("Bag", "ids")].rep_max == "3"